@@ -1,9 +1,15 @@
+import atexit
 import logging
 import os
-import warnings
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 
-from bidict import bidict
-from cachetools import cached, FIFOCache
+import numpy as np
+from cachetools import cached, LRUCache, TTLCache
+from eth_utils import event_abi_to_log_topic
+from web3._utils.abi import get_abi_output_types, map_abi_data
+from web3._utils.events import get_event_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
 from web3.exceptions import ContractLogicError
 from web3_multicall import Multicall
 
@@ -16,23 +22,74 @@ from utils.time_debug import timerun
 log = logging.getLogger("rocketpool")
 log.setLevel(cfg["log_level"])
 
+# contracts we look up often enough to warrant precomputing their storage keys
+KNOWN_CONTRACT_NAMES = [
+    "addressQueueStorage",
+    "casperDeposit",
+    "rocketAuctionManager",
+    "rocketDAONodeTrusted",
+    "rocketDAONodeTrustedSettingsMembers",
+    "rocketDAOProposal",
+    "rocketDAOProtocolSettingsDeposit",
+    "rocketDAOProtocolSettingsNetwork",
+    "rocketDepositPool",
+    "rocketMinipoolManager",
+    "rocketMinipoolQueue",
+    "rocketNetworkFees",
+    "rocketNetworkPrices",
+    "rocketNodeManager",
+    "rocketNodeStaking",
+    "rocketRewardsPool",
+    "rocketTokenRETH",
+    "rocketTokenRPL",
+    "rocketVault",
+]
+
+MINIPOOL_QUEUE_TYPES = [
+    "minipools.available.half",
+    "minipools.available.full",
+    "minipools.available.empty",
+]
+
+DISK_CACHE_VERSION = 1
+
+# canonical Multicall3 deployment, same address on all supported chains
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
 
 class RocketPool:
-    ADDRESS_CACHE = FIFOCache(maxsize=2048)
-    ABI_CACHE = FIFOCache(maxsize=2048)
-    CONTRACT_CACHE = FIFOCache(maxsize=2048)
+    ADDRESS_CACHE = LRUCache(maxsize=2048)
+    ABI_CACHE = LRUCache(maxsize=2048)
+    CONTRACT_CACHE = LRUCache(maxsize=2048)
 
     def __init__(self):
-        self.addresses = bidict()
+        self.addresses = {}
         self.multicall = None
+        # read all local abis once instead of hitting the disk on every cache miss
+        self._abi_text_cache = {}
+        with os.scandir("./contracts") as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.endswith(".abi.json"):
+                    with open(entry.path, "r") as f:
+                        self._abi_text_cache[entry.name.removesuffix(".abi.json")] = f.read()
+        self._factory_cache = {}
+        self.abis = {}
+        # http-provider calls release the gil while waiting on the node, so a modest
+        # thread pool is enough to overlap independent round trips
+        self._pool = ThreadPoolExecutor(max_workers=16)
         self.flush()
+        atexit.register(self.save_disk_cache)
 
     def flush(self):
         log.warning("FLUSHING RP CACHE")
         self.CONTRACT_CACHE.clear()
         self.ABI_CACHE.clear()
         self.ADDRESS_CACHE.clear()
-        self.addresses = bidict()
+        self._factory_cache = {}
+        self._rocket_storage = None
+        self._deposit_event = None
+        self.addresses = {}
+        self._addresses_rev = None
         try:
             self.multicall = Multicall(w3.eth)
         except Exception as err:
@@ -40,6 +97,84 @@ class RocketPool:
             self.multicall = None
         for name, address in cfg["rocketpool.manual_addresses"].items():
             self.addresses[name] = address
+        # precompute the storage keys for all known contracts, saves a keccak per lookup
+        self.name_to_address_key = {}
+        self.name_to_abi_key = {}
+        for name in set(KNOWN_CONTRACT_NAMES) | set(self.addresses):
+            self.name_to_address_key[name] = w3.soliditySha3(["string", "string"], ["contract.address", name])
+            self.name_to_abi_key[name] = w3.soliditySha3(["string", "string"], ["contract.abi", name])
+        self.minipool_queue_keys = {
+            queue_type: w3.soliditySha3(["string"], [queue_type]) for queue_type in MINIPOOL_QUEUE_TYPES
+        }
+        self.abis = {}
+        self.load_disk_cache()
+
+    def _disk_cache_path(self):
+        return f"./.rp_cache_{cfg['rocketpool.chain']}.pkl"
+
+    def _disk_cache_guard(self):
+        return {
+            "version"      : DISK_CACHE_VERSION,
+            "chain"        : cfg["rocketpool.chain"],
+            "rocketStorage": cfg["rocketpool.manual_addresses"].get("rocketStorage")
+        }
+
+    def load_disk_cache(self):
+        # reuse addresses and abis from the previous run, but only after checking them
+        # against the on-chain registry in a single multicall; entries whose address
+        # moved (e.g. upgraded contracts) fall out and get refetched lazily, which is
+        # what makes re-seeding from flush() safe
+        try:
+            with open(self._disk_cache_path(), "rb") as f:
+                data = pickle.load(f)
+            if data["guard"] != self._disk_cache_guard():
+                log.warning("Ignoring on-disk rp cache with mismatching guard")
+                return
+            names = [name for name in data["addresses"] if name not in self.addresses]
+            if not names:
+                return
+            get_address = self.get_rocket_storage().functions.getAddress
+            current = self.try_aggregate(
+                get_address(self.name_to_address_key.get(name)
+                            or w3.soliditySha3(["string", "string"], ["contract.address", name]))
+                for name in names
+            )
+            loaded = 0
+            for name, address in zip(names, current):
+                if address and address == data["addresses"][name]:
+                    self.addresses[name] = address
+                    if name in data["abis"]:
+                        self.abis[name] = data["abis"][name]
+                    loaded += 1
+            self._addresses_rev = None
+            log.debug(f"Loaded {loaded}/{len(names)} entries from the on-disk rp cache")
+            if loaded < len(names):
+                # rewrite the file so stale entries dont get re-verified every flush
+                self.save_disk_cache()
+        except FileNotFoundError:
+            pass
+        except Exception as err:
+            log.error(f"Failed to load on-disk rp cache: {err}")
+
+    def save_disk_cache(self):
+        try:
+            data = {
+                "guard"    : self._disk_cache_guard(),
+                "addresses": dict(self.addresses),
+                "abis"     : dict(self.abis)
+            }
+            tmp_path = f"{self._disk_cache_path()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(data, f)
+            os.replace(tmp_path, self._disk_cache_path())
+        except Exception as err:
+            log.error(f"Failed to save on-disk rp cache: {err}")
+
+    def get_rocket_storage(self):
+        # hit on every uncached address/abi lookup, so skip the cache layers and keep a direct reference
+        if self._rocket_storage is None:
+            self._rocket_storage = self.get_contract_by_name("rocketStorage")
+        return self._rocket_storage
 
     @cached(cache=ADDRESS_CACHE)
     def get_address_by_name(self, name):
@@ -50,11 +185,13 @@ class RocketPool:
 
     def uncached_get_address_by_name(self, name):
         log.debug(f"Retrieving address for {name} Contract")
-        sha3 = w3.soliditySha3(["string", "string"], ["contract.address", name])
-        address = self.get_contract_by_name("rocketStorage").functions.getAddress(sha3).call()
+        sha3 = self.name_to_address_key.get(name) or w3.soliditySha3(["string", "string"], ["contract.address", name])
+        address = self.get_rocket_storage().functions.getAddress(sha3).call()
         if not w3.toInt(hexstr=address):
             raise Exception(f"No address found for {name} Contract")
         self.addresses[name] = address
+        self._addresses_rev = None
+        self.save_disk_cache()
         log.debug(f"Retrieved address for {name} Contract: {address}")
         return address
 
@@ -84,33 +221,47 @@ class RocketPool:
         else:
             return None
 
+    def get_revert_reasons(self, tnxs):
+        # web3 5.x has no json-rpc batching and multicall cant replay from/gas/value,
+        # so run the simulations concurrently instead
+        if not tnxs:
+            return []
+        return list(self._pool.map(self.get_revert_reason, tnxs))
+
     @cached(cache=ABI_CACHE)
     def get_abi_by_name(self, name):
         return self.uncached_get_abi_by_name(name)
 
     def uncached_get_abi_by_name(self, name):
+        if name in self.abis:
+            return self.abis[name]
         log.debug(f"Retrieving abi for {name} Contract")
-        sha3 = w3.soliditySha3(["string", "string"], ["contract.abi", name])
-        compressed_string = self.get_contract_by_name("rocketStorage").functions.getString(sha3).call()
+        sha3 = self.name_to_abi_key.get(name) or w3.soliditySha3(["string", "string"], ["contract.abi", name])
+        compressed_string = self.get_rocket_storage().functions.getString(sha3).call()
         if not compressed_string:
             raise Exception(f"No abi found for {name} Contract")
-        return decode_abi(compressed_string)
+        abi = decode_abi(compressed_string)
+        self.abis[name] = abi
+        self.save_disk_cache()
+        return abi
 
     @cached(cache=CONTRACT_CACHE)
     def assemble_contract(self, name, address=None, mainnet=False):
-        abi = None
-
-        if os.path.exists(f"./contracts/{name}.abi.json"):
-            with open(f"./contracts/{name}.abi.json", "r") as f:
-                abi = f.read()
-        if not abi:
-            abi = self.get_abi_by_name(name)
-        if mainnet:
-            return mainnet_w3.eth.contract(address=address, abi=abi)
-        return w3.eth.contract(address=address, abi=abi)
+        # the factory does the expensive abi parsing, so keep one per (name, mainnet) and reuse it per address
+        if (factory := self._factory_cache.get((name, mainnet))) is None:
+            abi = self._abi_text_cache.get(name) or self.get_abi_by_name(name)
+            factory = (mainnet_w3 if mainnet else w3).eth.contract(abi=abi)
+            self._factory_cache[(name, mainnet)] = factory
+        if address is None:
+            return factory
+        return factory(address=address)
 
     def get_name_by_address(self, address):
-        return self.addresses.inverse.get(address, None)
+        # reverse lookups are rare, so build the reverse map lazily instead of
+        # maintaining a second hash table on every write
+        if self._addresses_rev is None:
+            self._addresses_rev = {a: n for n, a in self.addresses.items()}
+        return self._addresses_rev.get(address, None)
 
     def get_contract_by_name(self, name):
         address = self.get_address_by_name(name)
@@ -133,7 +284,11 @@ class RocketPool:
         return contract.functions[function](*args).estimateGas({"gas": 2 ** 32},
                                                                block_identifier=block)
 
-    def get_function(self, path, *args, address=None, mainnet=False):
+    def bind(self, path, address=None, mainnet=False):
+        """
+        Resolve `path` to its contract function once, so hot loops can skip the
+        string parsing and cache lookups `call` pays on every invocation.
+        """
         parts = path.split(".")
         if len(parts) != 2:
             raise Exception(f"Invalid contract path: Invalid part count: have {len(parts)}, want 2")
@@ -141,72 +296,150 @@ class RocketPool:
         if not address:
             address = self.get_address_by_name(name)
         contract = self.assemble_contract(name, address, mainnet)
-        return contract.functions[function](*args)
+        return contract.functions[function]
+
+    def get_function(self, path, *args, address=None, mainnet=False):
+        return self.bind(path, address=address, mainnet=mainnet)(*args)
 
     def call(self, path, *args, block="latest", address=None, mainnet=False):
         log.debug(f"Calling {path} (block={block})")
         return self.get_function(path, *args, address=address, mainnet=mainnet).call(block_identifier=block)
 
+    def batch_call(self, calls):
+        """
+        Execute multiple `(path, *args)` read calls in a single rpc request using multicall.
+        Results are returned in call order with the same shape `call` would produce.
+        """
+        log.debug(f"Batch calling {[call[0] for call in calls]}")
+        res = self.multicall.aggregate(self.get_function(path, *args) for path, *args in calls)
+        return [r.results[0] if len(r.results) == 1 else r.results for r in res.results]
+
+    def try_aggregate(self, calls, block="latest"):
+        """
+        Like multicall.aggregate, but goes through Multicall3's tryAggregate so a
+        reverting call maps to None instead of failing the whole batch.
+        """
+        calls = list(calls)
+        if not calls:
+            return []
+        multicall3 = self.assemble_contract("multicall3", w3.toChecksumAddress(MULTICALL3_ADDRESS))
+        payload = [(call.address, call._encode_transaction_data()) for call in calls]
+        response = multicall3.functions.tryAggregate(False, payload).call(block_identifier=block)
+        results = []
+        for call, (success, return_data) in zip(calls, response):
+            if not success:
+                results.append(None)
+                continue
+            output_types = get_abi_output_types(call.abi)
+            decoded = w3.codec.decode_abi(output_types, return_data)
+            # run the same normalizers call_contract_function applies, e.g. checksummed addresses
+            decoded = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, decoded)
+            results.append(decoded[0] if len(decoded) == 1 else list(decoded))
+        return results
+
+    def parallel_call(self, calls):
+        """
+        Run multiple `(path, *args)` read calls concurrently on the shared thread pool.
+        Unlike `batch_call` this also covers calls multicall can't express (e.g. mainnet reads).
+        """
+        log.debug(f"Parallel calling {[call[0] for call in calls]}")
+        return list(self._pool.map(lambda call: self.call(call[0], *call[1:]), calls))
+
     def get_pubkey_using_transaction(self, receipt):
-        # will throw some warnings about other events but those are safe to ignore since we don't need those anyways
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            processed_logs = self.get_contract_by_name("casperDeposit").events.DepositEvent().processReceipt(receipt)
+        # processReceipt tries every abi against every log; we only care about one known
+        # event, so match on its topic directly and decode just that log
+        if self._deposit_event is None:
+            casper = self.get_contract_by_name("casperDeposit")
+            event_abi = casper.events.DepositEvent._get_event_abi()
+            self._deposit_event = (casper.address, event_abi_to_log_topic(event_abi), event_abi)
+        address, topic, event_abi = self._deposit_event
 
-        # attempt to retrieve the pubkey
-        if processed_logs:
-            deposit_event = processed_logs[0]
-            return deposit_event.args.pubkey.hex()
+        for log_entry in receipt.logs:
+            if log_entry.address == address and log_entry.topics and log_entry.topics[0] == topic:
+                return get_event_data(w3.codec, event_abi, log_entry).args.pubkey.hex()
 
+    @cached(cache=TTLCache(maxsize=1, ttl=60))
     def get_annual_rpl_inflation(self):
-        inflation_per_interval = solidity.to_float(self.call("rocketTokenRPL.getInflationIntervalRate"))
+        rate, seconds_per_interval = self.batch_call([
+            ("rocketTokenRPL.getInflationIntervalRate",),
+            ("rocketTokenRPL.getInflationIntervalTime",)
+        ])
+        inflation_per_interval = solidity.to_float(rate)
         if not inflation_per_interval:
             return 0
-        seconds_per_interval = self.call("rocketTokenRPL.getInflationIntervalTime")
         intervals_per_year = solidity.years / seconds_per_interval
         return (inflation_per_interval ** intervals_per_year) - 1
 
+    @cached(cache=TTLCache(maxsize=1, ttl=60))
     def get_percentage_rpl_swapped(self):
         value = solidity.to_float(self.call("rocketTokenRPL.totalSwappedRPL"))
         percentage = (value / 18_000_000) * 100
         return round(percentage, 2)
 
     def get_minipools_by_type(self, minipool_type, limit=10):
-        key = w3.soliditySha3(["string"], [minipool_type])
-        cap = self.call("addressQueueStorage.getLength", key)
+        key = self.minipool_queue_keys.get(minipool_type) or w3.soliditySha3(["string"], [minipool_type])
+        queue = self.get_contract_by_name("addressQueueStorage")
+        # pin everything to one block so the length and the items describe the same queue state
+        block = w3.eth.blockNumber
+        cap = queue.functions.getLength(key).call(block_identifier=block)
         limit = min(cap, limit)
-        results = [
-            self.call("addressQueueStorage.getItem", key, i) for i in range(limit)
-        ]
-
-        return cap, results
+        if not limit:
+            return cap, []
+        get_item = queue.functions.getItem
+        items = self.try_aggregate((get_item(key, i) for i in range(limit)), block=block)
+        return cap, [item for item in items if item is not None]
 
     def get_minipools(self, limit=10):
-        return {
-            "half" : self.get_minipools_by_type("minipools.available.half", limit),
-            "full" : self.get_minipools_by_type("minipools.available.full", limit),
-            "empty": self.get_minipools_by_type("minipools.available.empty", limit)
+        minipool_types = {
+            "half" : "minipools.available.half",
+            "full" : "minipools.available.full",
+            "empty": "minipools.available.empty"
         }
+        queue = self.get_contract_by_name("addressQueueStorage")
+        get_length, get_item = queue.functions.getLength, queue.functions.getItem
+        keys = {name: self.minipool_queue_keys[t] for name, t in minipool_types.items()}
+        # one multicall for all queue lengths, then one for every queued minipool,
+        # both pinned to the same block for a consistent snapshot of the queues
+        block = w3.eth.blockNumber
+        res = self.try_aggregate((get_length(key) for key in keys.values()), block=block)
+        caps = {name: cap or 0 for name, cap in zip(keys, res)}
+        item_calls = [
+            (name, get_item(keys[name], i))
+            for name in keys for i in range(min(caps[name], limit))
+        ]
+        minipools = {name: (caps[name], []) for name in keys}
+        if item_calls:
+            items = self.try_aggregate((call for _, call in item_calls), block=block)
+            for (name, _), item in zip(item_calls, items):
+                if item is not None:
+                    minipools[name][1].append(item)
+        return minipools
 
+    @cached(cache=TTLCache(maxsize=1, ttl=12))
     def get_dai_eth_price(self):
         data = self.call("DAIETH_univ3.slot0", mainnet=True)
-        value_dai = data[0] ** 2 / 2 ** 192
+        sqrt_price_x96 = data[0]
+        value_dai = (sqrt_price_x96 * sqrt_price_x96) / (1 << 192)
         return 1 / value_dai
 
     @timerun
     def get_minipool_count_per_status(self):
-        offset, limit = 0, 10000
-        minipool_count_per_status = [0, 0, 0, 0, 0]
+        offset, limit, batch_size = 0, 10000, 8
+        minipool_count_per_status = np.zeros(5, dtype=np.int64)
+        get_count = self.bind("rocketMinipoolManager.getMinipoolCountPerStatus")
         while True:
-            log.debug(f"getMinipoolCountPerStatus({offset}, {limit})")
-            tmp = self.call("rocketMinipoolManager.getMinipoolCountPerStatus", offset, limit)
-            for i in range(len(tmp)):
-                minipool_count_per_status[i] += tmp[i]
-            if sum(tmp) < limit:
+            log.debug(f"getMinipoolCountPerStatus({offset}, {limit}) x{batch_size}")
+            # speculatively request multiple ranges in a single multicall, most of the time one round trip is enough
+            res = self.try_aggregate(
+                get_count(offset + i * limit, limit) for i in range(batch_size)
+            )
+            chunks = np.array([r if r is not None else [0] * 5 for r in res], dtype=np.int64)
+            minipool_count_per_status += chunks.sum(axis=0)
+            if chunks[-1].sum() < limit:
                 break
-            offset += limit
+            offset += batch_size * limit
         return dict(zip(["initialisedCount", "prelaunchCount", "stakingCount", "withdrawableCount", "dissolvedCount"],
-                        minipool_count_per_status))
+                        minipool_count_per_status.tolist()))
 
 
 rp = RocketPool()
@@ -1,28 +1,81 @@
 import logging
 import math
+import time
 
 import circuitbreaker
 import requests
 from requests import HTTPError, ConnectTimeout
+from requests.adapters import HTTPAdapter
 from retry import retry
+from urllib3.util.retry import Retry
 from web3 import Web3, HTTPProvider
+from web3._utils.request import cache_session
 from web3.beacon import Beacon as Bacon
 from web3.middleware import geth_poa_middleware
+from web3.providers import JSONBaseProvider
 
 from utils.cfg import cfg
 
 log = logging.getLogger("shared_w3")
 log.setLevel(cfg["log_level"])
 
-w3 = Web3(HTTPProvider(cfg['rocketpool.execution_layer.endpoint.current']))
+
+class LoadBalancedHTTPProvider(JSONBaseProvider):
+    """
+    Spreads requests across multiple http endpoints, preferring the one with the
+    lowest smoothed latency and failing over to the remaining ones on error.
+    """
+
+    def __init__(self, endpoints):
+        super().__init__()
+        self.providers = [HTTPProvider(endpoint) for endpoint in endpoints]
+        self.latencies = [0.0] * len(self.providers)
+
+    def make_request(self, method, params):
+        order = sorted(range(len(self.providers)), key=lambda i: self.latencies[i])
+        for rank, i in enumerate(order):
+            provider = self.providers[i]
+            start = time.monotonic()
+            try:
+                response = provider.make_request(method, params)
+            except Exception as err:
+                if rank == len(order) - 1:
+                    raise
+                log.warning(f"{provider.endpoint_uri} failed {method}: {err}, trying next provider")
+                # push the provider to the back until its latency estimate recovers
+                self.latencies[i] = max(self.latencies) + 1
+                continue
+            self.latencies[i] = 0.8 * self.latencies[i] + 0.2 * (time.monotonic() - start)
+            return response
+
+
+def _make_w3(endpoint):
+    # mount a session with a generous connection pool so bursts of eth_calls reuse
+    # kept-alive connections instead of paying a tcp/tls handshake per call
+    endpoints = [endpoint] if isinstance(endpoint, str) else list(endpoint)
+    for url in endpoints:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32,
+                              pool_maxsize=64,
+                              max_retries=Retry(total=2, backoff_factor=0.1, allowed_methods=None))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers["Connection"] = "keep-alive"
+        cache_session(url, session)
+    if len(endpoints) == 1:
+        return Web3(HTTPProvider(endpoints[0]))
+    return Web3(LoadBalancedHTTPProvider(endpoints))
+
+
+w3 = _make_w3(cfg['rocketpool.execution_layer.endpoint.current'])
 mainnet_w3 = w3
 if "goerli" in cfg['rocketpool.execution_layer.endpoint'].keys():
-    goerli_w3 = Web3(HTTPProvider(cfg['rocketpool.execution_layer.endpoint.goerli']))
+    goerli_w3 = _make_w3(cfg['rocketpool.execution_layer.endpoint.goerli'])
     goerli_w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 
 
 if cfg['rocketpool.chain'] != "mainnet":
-    mainnet_w3 = Web3(HTTPProvider(cfg['rocketpool.execution_layer.endpoint.mainnet']))
+    mainnet_w3 = _make_w3(cfg['rocketpool.execution_layer.endpoint.mainnet'])
 
     w3.middleware_onion.inject(geth_poa_middleware, layer=0)
 